@@ -0,0 +1,264 @@
+"""
+RETINA Bulk Offline Scoring
+Score a whole image directory or tar archive with any registered model
+
+Images are decoded and preprocessed by a pool of worker threads while the
+model runs batched forward passes. Results are appended to JSONL, flushed
+after every batch, or to Parquet part files of --rows-per-part rows, so an
+interrupted run picks up where it stopped: images already present in the
+output are skipped and images that failed to read are retried (a retried
+image gets a new row after its earlier error row).
+
+Usage:
+    python bulk_score.py datasets --model outer_eye --output scores.jsonl
+    python bulk_score.py backlog.tar --model retfound --output scores.jsonl
+    python bulk_score.py datasets --model retfound --format parquet --output scores_parquet/
+"""
+
+import argparse
+import io
+import json
+import os
+import sys
+import tarfile
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from model_registry import ModelRegistry, format_prediction, load_model_specs
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+# -----------------------------
+# 📂 INPUT SOURCES
+# -----------------------------
+def iter_directory(root):
+    """Yield (key, loader) for every image under `root`, in a stable order"""
+    root = Path(root)
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                path = Path(dirpath) / filename
+                yield path.relative_to(root).as_posix(), path.read_bytes
+
+
+def iter_tar(archive, skip=()):
+    """Yield (key, loader) for every image member of a tar archive, streaming"""
+    with tarfile.open(archive, mode='r|*') as tar:
+        for member in tar:
+            if member.name in skip:
+                continue
+            if member.isfile() and member.name.lower().endswith(IMAGE_EXTENSIONS):
+                # Streaming tars can only be read sequentially, so read here
+                data = tar.extractfile(member).read()
+                yield member.name, (lambda data=data: data)
+
+
+def iter_images(source, skip=()):
+    """Images from a directory or tar, leaving out keys in `skip`"""
+    if Path(source).is_dir():
+        return ((key, loader) for key, loader in iter_directory(source) if key not in skip)
+    return iter_tar(source, skip)
+
+
+# -----------------------------
+# 💾 OUTPUT SINKS
+# -----------------------------
+class JsonlSink:
+    """Append-only JSONL; a torn last line from a crash is dropped on resume"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.done = set()
+        good_bytes = 0
+        if self.path.exists():
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        path = record['path']
+                    except (ValueError, KeyError):
+                        break
+                    # Failed reads are retried on resume rather than skipped forever
+                    if 'error' not in record:
+                        self.done.add(path)
+                    good_bytes += len(line)
+            with open(self.path, 'r+b') as f:
+                f.truncate(good_bytes)
+        self.file = open(self.path, 'a')
+
+    def write(self, records):
+        for record in records:
+            self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetSink:
+    """
+    One Parquet part file per `rows_per_part` rows inside an output directory.
+    Every part shares one fixed schema so the directory reads as a dataset.
+    """
+
+    def __init__(self, path, class_names, rows_per_part=256):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa, self.pq = pa, pq
+        self.dir = Path(path)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.class_names = class_names
+        self.rows_per_part = rows_per_part
+        self.schema = pa.schema(
+            [('path', pa.string()), ('model', pa.string()),
+             ('predicted_class', pa.string()), ('confidence', pa.float64()),
+             ('error', pa.string())]
+            + [(f'prob_{name}', pa.float64()) for name in class_names]
+        )
+        self.buffer = []
+        self.done = set()
+        parts = sorted(self.dir.glob('part-*.parquet'))
+        for part in parts:
+            table = pq.read_table(part, columns=['path', 'error']).to_pydict()
+            # Failed reads are retried on resume rather than skipped forever
+            self.done.update(p for p, err in zip(table['path'], table['error']) if err is None)
+        self.next_part = len(parts)
+
+    def write(self, records):
+        for record in records:
+            row = {
+                'path': record['path'],
+                'model': record['model'],
+                'predicted_class': record.get('predicted_class'),
+                'confidence': record.get('confidence'),
+                'error': record.get('error'),
+            }
+            probs = record.get('probabilities', {})
+            for name in self.class_names:
+                row[f'prob_{name}'] = probs.get(name)
+            self.buffer.append(row)
+        if len(self.buffer) >= self.rows_per_part:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        part = self.dir / f'part-{self.next_part:05d}.parquet'
+        tmp = part.with_suffix('.tmp')
+        self.pq.write_table(self.pa.Table.from_pylist(self.buffer, schema=self.schema), tmp)
+        os.replace(tmp, part)  # a part is either complete or absent
+        self.next_part += 1
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+
+
+# -----------------------------
+# 🚀 SCORING LOOP
+# -----------------------------
+def decode(model, key, loader):
+    try:
+        img = Image.open(io.BytesIO(loader())).convert('RGB')
+        return key, model.preprocess(img), None
+    except Exception as e:
+        return key, None, str(e)
+
+
+def score(source, model_name, output, fmt='jsonl', batch_size=32, workers=4,
+          config=None, memory_budget_mb=8192, rows_per_part=256):
+    registry = ModelRegistry(load_model_specs(config), memory_budget_mb=memory_budget_mb)
+    model = registry.get(model_name)
+    class_names = model.class_names
+
+    sink = JsonlSink(output) if fmt == 'jsonl' else ParquetSink(output, class_names, rows_per_part)
+    if sink.done:
+        print(f"⏩ Resuming: {len(sink.done)} images already scored in {output}")
+
+    pending = deque()
+    prefetch = batch_size * 4
+    scored = 0
+    start = last_report = time.perf_counter()
+
+    def run_batch(items):
+        records = []
+        ok = [(key, arr) for key, arr, err in items if err is None]
+        if ok:
+            probs = model.predict(np.stack([arr for _, arr in ok]))
+            for (key, _), p in zip(ok, probs):
+                records.append({'path': key, 'model': model_name, **format_prediction(p, class_names)})
+        for key, _, err in items:
+            if err is not None:
+                print(f"⚠️ Could not read {key}: {err}")
+                records.append({'path': key, 'model': model_name, 'error': err})
+        sink.write(records)
+        return len(items)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for key, loader in iter_images(source, skip=sink.done):
+                pending.append(pool.submit(decode, model, key, loader))
+                if len(pending) >= prefetch:
+                    scored += run_batch([pending.popleft().result() for _ in range(batch_size)])
+
+                    now = time.perf_counter()
+                    if now - last_report >= 10:
+                        print(f"📊 {scored} images | {scored / (now - start):.1f} images/s")
+                        last_report = now
+
+            while pending:
+                n = min(batch_size, len(pending))
+                scored += run_batch([pending.popleft().result() for _ in range(n)])
+    finally:
+        sink.close()
+
+    elapsed = time.perf_counter() - start
+    rate = scored / elapsed if elapsed > 0 else 0.0
+    print(f"\n✅ Scored {scored} images in {elapsed:.1f}s ({rate:.1f} images/s)")
+    print(f"💾 Results: {output}")
+    return {'images': scored, 'seconds': elapsed, 'images_per_sec': rate}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='RETINA bulk offline scoring')
+    parser.add_argument('source', help='Image directory or tar archive (.tar, .tar.gz, ...)')
+    parser.add_argument('--model', required=True, help='Registered model name (retfound, outer_eye, ...)')
+    parser.add_argument('--output', required=True, help='JSONL file, or directory for --format parquet')
+    parser.add_argument('--format', choices=['jsonl', 'parquet'], default='jsonl', help='Output format')
+    parser.add_argument('--batch-size', type=int, default=32, help='Images per forward pass')
+    parser.add_argument('--workers', type=int, default=4, help='Decode worker threads')
+    parser.add_argument('--config', help='JSON file with extra model specs')
+    parser.add_argument('--rows-per-part', type=int, default=256,
+                        help='Parquet rows per part file (at most this many are lost on a crash)')
+    args = parser.parse_args()
+
+    if not Path(args.source).exists():
+        print(f"❌ Source not found: {args.source}")
+        sys.exit(1)
+
+    model_names = [spec.name for spec in load_model_specs(args.config)]
+    if args.model not in model_names:
+        print(f"❌ Unknown model: {args.model} (registered: {', '.join(model_names)})")
+        sys.exit(1)
+
+    print("=" * 60)
+    print("🏥 RETINA: Bulk Scoring")
+    print("=" * 60)
+
+    score(args.source, args.model, args.output, fmt=args.format,
+          batch_size=args.batch_size, workers=args.workers, config=args.config,
+          rows_per_part=args.rows_per_part)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+"""
+Streaming Evaluation
+Shared classification metrics for the RETINA training scripts
+
+StreamingEvaluator is fed one batch at a time and accumulates a confusion
+matrix and calibration bins with bincount, on whatever device the batch
+lives on (torch tensors stay on-tensor; numpy / TensorFlow outputs use
+numpy). Nothing is pulled back to the host until compute(), unless the
+raw scores are being kept for caching.
+
+Scores (logits or probabilities) can be cached to .npz, optionally with
+embeddings, so metrics can be recomputed, e.g. with new per-class
+thresholds, without running the model again.
+
+Usage:
+    evaluator = StreamingEvaluator(CLASS_NAMES, keep_scores=True)
+    for images, labels in loader:
+        evaluator.update(model(images), labels)
+    print_report(evaluator.compute())
+    evaluator.save_cache('test_logits.npz')
+
+    metrics = evaluate_cache('test_logits.npz', thresholds=[0.5, 0.3, 0.5, 0.5])
+    metrics = evaluate_cache('test_logits.npz', head=linear_head(weight, bias))
+"""
+
+import json
+
+import numpy as np
+
+
+def _is_torch(x):
+    return type(x).__module__.startswith('torch')
+
+
+class StreamingEvaluator:
+    """
+    Confusion matrix, per-class precision/recall/F1 and expected calibration
+    error (ECE) accumulated over batches.
+
+    `thresholds` are optional per-class probability thresholds: the predicted
+    class is argmax(probs / thresholds), so equal thresholds reduce to plain
+    argmax. Calibration (ECE) always uses the raw top-class probability and
+    plain-argmax correctness, so it does not change with the thresholds.
+    """
+
+    def __init__(self, class_names, n_bins=15, thresholds=None, keep_scores=False):
+        self.class_names = list(class_names)
+        self.num_classes = len(self.class_names)
+        self.n_bins = n_bins
+        self.thresholds = None if thresholds is None else np.asarray(thresholds, dtype=np.float32)
+        if self.thresholds is not None and self.thresholds.shape != (self.num_classes,):
+            raise ValueError(f"Expected {self.num_classes} thresholds, got {len(self.thresholds)}")
+        self.keep_scores = keep_scores
+        self.reset()
+
+    def reset(self):
+        self._state = None
+        self._scores, self._labels, self._embeddings = [], [], []
+        self._from_probs = None
+
+    def update(self, scores, labels, from_probs=False, embeddings=None):
+        """Add one batch of logits (or probabilities, with from_probs=True)"""
+        if _is_torch(scores):
+            delta = self._batch_stats_torch(scores, labels, from_probs)
+        else:
+            delta = self._batch_stats_numpy(np.asarray(scores), np.asarray(labels), from_probs)
+
+        if self._state is None:
+            self._state = list(delta)
+        else:
+            for acc, d in zip(self._state, delta):
+                acc += d
+
+        if self.keep_scores:
+            self._from_probs = from_probs
+            self._scores.append(_to_numpy(scores))
+            self._labels.append(_to_numpy(labels))
+            if embeddings is not None:
+                self._embeddings.append(_to_numpy(embeddings))
+
+    def _batch_stats_torch(self, scores, labels, from_probs):
+        import torch
+
+        k, n_bins = self.num_classes, self.n_bins
+        scores = scores.detach()
+        labels = labels.to(scores.device).long()
+        probs = scores.float() if from_probs else torch.softmax(scores.float(), dim=1)
+        conf, top = probs.max(dim=1)
+        if self.thresholds is not None:
+            pred = (probs / torch.as_tensor(self.thresholds, device=probs.device)).argmax(dim=1)
+        else:
+            pred = top
+
+        confusion = torch.bincount(labels * k + pred, minlength=k * k).view(k, k)
+        bins = (conf * n_bins).long().clamp_(0, n_bins - 1)
+        # Calibration is a property of the probabilities, not of the thresholds
+        correct = top.eq(labels).double()
+        return (
+            confusion,
+            torch.bincount(bins, minlength=n_bins),
+            torch.bincount(bins, weights=conf.double(), minlength=n_bins),
+            torch.bincount(bins, weights=correct, minlength=n_bins),
+        )
+
+    def _batch_stats_numpy(self, scores, labels, from_probs):
+        k, n_bins = self.num_classes, self.n_bins
+        labels = labels.astype(np.int64)
+        probs = scores.astype(np.float64) if from_probs else _softmax(scores.astype(np.float64))
+        conf = probs.max(axis=1)
+        top = probs.argmax(axis=1)
+        pred = top if self.thresholds is None else (probs / self.thresholds).argmax(axis=1)
+
+        confusion = np.bincount(labels * k + pred, minlength=k * k).reshape(k, k)
+        bins = np.clip((conf * n_bins).astype(np.int64), 0, n_bins - 1)
+        # Calibration is a property of the probabilities, not of the thresholds
+        correct = (top == labels).astype(np.float64)
+        return (
+            confusion,
+            np.bincount(bins, minlength=n_bins),
+            np.bincount(bins, weights=conf, minlength=n_bins),
+            np.bincount(bins, weights=correct, minlength=n_bins),
+        )
+
+    def compute(self):
+        """Metrics dict; the only point where accumulated state leaves the device"""
+        if self._state is None:
+            raise ValueError("No batches to evaluate")
+        confusion, bin_count, bin_conf, bin_correct = (_to_numpy(s).astype(np.float64) for s in self._state)
+
+        total = confusion.sum()
+        tp = np.diag(confusion)
+        support = confusion.sum(axis=1)
+        predicted = confusion.sum(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            precision = np.where(predicted > 0, tp / predicted, 0.0)
+            recall = np.where(support > 0, tp / support, 0.0)
+            f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+            bin_gap = np.where(bin_count > 0, np.abs(bin_correct - bin_conf) / np.maximum(bin_count, 1), 0.0)
+        ece = float(np.sum(bin_count / total * bin_gap))
+
+        present = support > 0
+        per_class = {
+            name: {
+                'precision': float(precision[i]),
+                'recall': float(recall[i]),
+                'f1': float(f1[i]),
+                'support': int(support[i]),
+            }
+            for i, name in enumerate(self.class_names)
+        }
+        return {
+            'accuracy': float(tp.sum() / total),
+            'macro_f1': float(f1[present].mean()) if present.any() else 0.0,
+            'weighted_f1': float(np.sum(f1 * support) / support.sum()),
+            'ece': ece,
+            'total': int(total),
+            'per_class': per_class,
+            'confusion_matrix': confusion.astype(np.int64).tolist(),
+            'class_names': self.class_names,
+        }
+
+    def save_cache(self, path):
+        """Write the scores seen so far (requires keep_scores=True) to .npz"""
+        if not self.keep_scores or not self._scores:
+            raise ValueError("No cached scores; create the evaluator with keep_scores=True")
+        arrays = {
+            'scores': np.concatenate(self._scores),
+            'labels': np.concatenate(self._labels),
+            'from_probs': np.array(self._from_probs),
+            'class_names': np.array(json.dumps(self.class_names)),
+        }
+        if self._embeddings:
+            arrays['embeddings'] = np.concatenate(self._embeddings)
+        np.savez_compressed(path, **arrays)
+
+
+def load_cache(path):
+    """Load a score cache written by StreamingEvaluator.save_cache()"""
+    with np.load(path) as data:
+        cache = {
+            'scores': data['scores'],
+            'labels': data['labels'],
+            'from_probs': bool(data['from_probs']),
+            'class_names': json.loads(str(data['class_names'])),
+        }
+        if 'embeddings' in data:
+            cache['embeddings'] = data['embeddings']
+    return cache
+
+
+def evaluate_cache(path, thresholds=None, n_bins=15, head=None):
+    """
+    Recompute metrics from cached scores without touching the model.
+
+    With `head` (a callable mapping embeddings -> logits, e.g. a retrained
+    linear head), the cached embeddings are re-scored instead of the cached
+    scores, so a new head can be evaluated without the backbone.
+    """
+    cache = load_cache(path)
+    evaluator = StreamingEvaluator(cache['class_names'], n_bins=n_bins, thresholds=thresholds)
+    if head is not None:
+        if 'embeddings' not in cache:
+            raise ValueError(f"{path} has no cached embeddings to re-score")
+        evaluator.update(head(cache['embeddings']), cache['labels'])
+    else:
+        evaluator.update(cache['scores'], cache['labels'], from_probs=cache['from_probs'])
+    return evaluator.compute()
+
+
+def linear_head(weight, bias):
+    """Numpy logits = embeddings @ weight.T + bias, for evaluate_cache(head=...)"""
+    weight, bias = np.asarray(weight), np.asarray(bias)
+    return lambda embeddings: embeddings @ weight.T + bias
+
+
+def print_report(metrics):
+    """Console report in the style of the training scripts"""
+    print(f"\n🎯 Overall Accuracy: {100. * metrics['accuracy']:.2f}%")
+    print(f"📐 Macro F1: {metrics['macro_f1']:.4f} | Weighted F1: {metrics['weighted_f1']:.4f}")
+    print(f"🌡️  Expected Calibration Error: {metrics['ece']:.4f}")
+    print("\nPer-class Metrics:")
+    width = max(len(name) for name in metrics['class_names'])
+    for name, m in metrics['per_class'].items():
+        if m['support'] > 0:
+            print(f"  {name:<{width}}  precision {m['precision']:.3f}  recall {m['recall']:.3f}  "
+                  f"f1 {m['f1']:.3f}  ({m['support']})")
+
+
+def _softmax(x):
+    x = x - x.max(axis=1, keepdims=True)
+    e = np.exp(x)
+    return e / e.sum(axis=1, keepdims=True)
+
+
+def _to_numpy(x):
+    if _is_torch(x):
+        return x.detach().cpu().numpy()
+    return np.asarray(x)
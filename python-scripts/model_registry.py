@@ -0,0 +1,405 @@
+"""
+Model Registry
+Shared model loading, residency and batching for RETINA inference
+
+Both model families (the Keras MobileNetV2 outer-eye classifier and the
+RETFound ViT) are wrapped in a common adapter interface so a single process
+can serve them side by side:
+
+    preprocess(PIL.Image) -> np.ndarray      # one image, model input layout
+    predict(np.ndarray)   -> np.ndarray      # batch of inputs -> probabilities
+
+ModelRegistry loads models on demand and keeps the resident set within a RAM
+budget, evicting the least recently used model first. BatchScheduler owns one
+request queue and one thread pool for all models, grouping pending requests
+per model into batched forward passes.
+
+Usage:
+    registry = ModelRegistry(default_model_specs(), memory_budget_mb=4096)
+    scheduler = BatchScheduler(registry)
+    result = scheduler.submit('retfound', pil_image).result()
+"""
+
+import json
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = Path(__file__).resolve().parent
+
+# Both models are trained on sorted class indices: ImageFolder for RETFound,
+# LabelEncoder for MobileNetV2. The training scripts also record the order
+# (checkpoint 'class_names' / a .classes.json next to the .h5)
+RETFOUND_CLASS_NAMES = sorted(['glaucoma', 'retinopathy', 'cataract', 'normal'])
+OUTER_EYE_DISEASES = sorted(["Normal", "Uveitis", "Conjunctivitis", "Cataract", "Eyelid Drooping"])
+
+
+class ModelSpec:
+    """Describes a servable model: its routing name, family and weights"""
+
+    def __init__(self, name, kind, path, class_names):
+        if kind not in MODEL_KINDS:
+            raise ValueError(f"Unknown model kind '{kind}' for {name} (expected one of {sorted(MODEL_KINDS)})")
+        self.name = name
+        self.kind = kind
+        self.path = Path(path)
+        self.class_names = list(class_names)
+
+    def estimated_bytes(self):
+        """Pre-load size estimate of the weights, used to make room before loading"""
+        return MODEL_KINDS[self.kind].estimate_bytes(self)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'kind': self.kind,
+            'path': str(self.path),
+            'classes': self.class_names,
+        }
+
+
+class RetfoundModel:
+    """RETFound ViT-B/16 fine-tuned checkpoint (PyTorch)"""
+
+    # vit_base_patch16_224 without its classification head
+    BACKBONE_PARAMS = 85_798_656
+    EMBED_DIM = 768
+
+    @classmethod
+    def estimate_bytes(cls, spec):
+        # The .pth also holds AdamW state (~3x the weights), so size from the architecture
+        params = cls.BACKBONE_PARAMS + (cls.EMBED_DIM + 1) * len(spec.class_names)
+        return params * 4
+
+    def __init__(self, spec, device=None):
+        import torch
+        import timm
+        from torchvision import transforms
+
+        self.spec = spec
+        self.device = torch.device(device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+
+        checkpoint = torch.load(spec.path, map_location=self.device)
+        # Head outputs follow ImageFolder's sorted folder order. Older checkpoints
+        # stored the names unsorted, so sort whatever the checkpoint recorded
+        self.class_names = sorted(checkpoint.get('class_names', spec.class_names))
+
+        model = timm.create_model('vit_base_patch16_224', pretrained=False)
+        model.head = torch.nn.Linear(model.head.in_features, len(self.class_names))
+        model.load_state_dict(checkpoint['model_state_dict'])
+        self.model = model.to(self.device).eval()
+
+        # Same eval transform as retfound_setup.get_data_transforms() / retfound_api.py
+        self.transform = transforms.Compose([
+            transforms.Resize(256),
+            transforms.CenterCrop(224),
+            transforms.ToTensor(),
+            transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+        ])
+
+        tensors = list(self.model.parameters()) + list(self.model.buffers())
+        self.memory_bytes = sum(t.numel() * t.element_size() for t in tensors)
+
+    def preprocess(self, img):
+        """Resize(256) -> CenterCrop(224) -> Normalize, as in retfound_setup.py"""
+        return self.transform(img.convert('RGB')).numpy()
+
+    def predict(self, batch):
+        import torch
+
+        with torch.no_grad():
+            inputs = torch.from_numpy(np.ascontiguousarray(batch)).to(self.device)
+            outputs = self.model(inputs)
+            return torch.nn.functional.softmax(outputs, dim=1).cpu().numpy()
+
+
+class KerasModel:
+    """Keras MobileNetV2 outer-eye classifier (.h5 / SavedModel)"""
+
+    @classmethod
+    def estimate_bytes(cls, spec):
+        # Only the small trainable head carries optimizer slots, so the file is close
+        return spec.path.stat().st_size if spec.path.exists() else 0
+
+    def __init__(self, spec, device=None):
+        import tensorflow as tf
+
+        self.spec = spec
+        self.model = tf.keras.models.load_model(str(spec.path))
+        self.class_names = load_class_order(spec.path) or spec.class_names
+        # Variable.dtype is a string on Keras 3, so size the arrays themselves
+        self.memory_bytes = sum(w.numpy().nbytes for w in self.model.weights)
+
+    def preprocess(self, img):
+        """Resize to 224x224 and scale to [0, 1], as in train_outer_eye_mobilenetv2.py"""
+        # keras.preprocessing.image.load_img resizes with nearest-neighbour by default
+        img = img.convert('RGB').resize((224, 224), Image.NEAREST)
+        return np.asarray(img, dtype=np.float32) / 255.0
+
+    def predict(self, batch):
+        return np.asarray(self.model(batch, training=False))
+
+
+def class_order_path(model_path):
+    """Sidecar file recording the output index -> class name order of a model"""
+    model_path = Path(model_path)
+    return model_path.with_name(model_path.stem + '.classes.json')
+
+
+def load_class_order(model_path):
+    path = class_order_path(model_path)
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+MODEL_KINDS = {
+    'retfound': RetfoundModel,
+    'keras': KerasModel,
+}
+
+
+def default_model_specs():
+    """The two models produced by the training scripts in this directory"""
+    retfound_dir = BASE_DIR.parent / 'models' / 'retfound'
+    retfound_ckpt = retfound_dir / 'retfound_finetuned_best.pth'
+    if not retfound_ckpt.exists():
+        retfound_ckpt = retfound_dir / 'retfound_finetuned.pth'
+
+    return [
+        ModelSpec('retfound', 'retfound', retfound_ckpt, RETFOUND_CLASS_NAMES),
+        ModelSpec('outer_eye', 'keras',
+                  BASE_DIR.parent / 'backend' / 'models' / 'outer_eye_mobilenetv2.h5',
+                  OUTER_EYE_DISEASES),
+    ]
+
+
+def load_model_specs(config_path=None):
+    """
+    Default specs, extended/overridden by an optional JSON config:
+
+        [{"name": "retfound-v2", "kind": "retfound",
+          "path": "../models/retfound/retfound_v2.pth",
+          "class_names": ["glaucoma", "retinopathy", "cataract", "normal"]}]
+
+    Relative paths are resolved against the config file's directory.
+    """
+    specs = OrderedDict((spec.name, spec) for spec in default_model_specs())
+    if config_path:
+        config_path = Path(config_path)
+        with open(config_path) as f:
+            entries = json.load(f)
+        for entry in entries:
+            path = Path(entry['path'])
+            if not path.is_absolute():
+                path = config_path.parent / path
+            specs[entry['name']] = ModelSpec(entry['name'], entry['kind'], path, entry['class_names'])
+    return list(specs.values())
+
+
+def format_prediction(probs, class_names):
+    """Response payload shared by every model, matching retfound_api.py"""
+    pred_index = int(np.argmax(probs))
+    return {
+        'probabilities': {name: float(p) for name, p in zip(class_names, probs)},
+        'predicted_class': class_names[pred_index],
+        'confidence': float(probs[pred_index]),
+    }
+
+
+class ModelRegistry:
+    """
+    Name -> model lookup with on-demand loading and LRU eviction.
+
+    Resident models are kept in an OrderedDict ordered by last use. Before a
+    model is loaded, least recently used models are evicted until its
+    estimated weight size (or the footprint measured on an earlier load)
+    fits in the memory budget; once loaded its real footprint replaces the
+    estimate. A model larger than the whole budget is still
+    served, alone.
+    """
+
+    def __init__(self, specs, memory_budget_mb=4096, device=None):
+        self.specs = OrderedDict((spec.name, spec) for spec in specs)
+        self.memory_budget = int(memory_budget_mb * 1024 * 1024)
+        self.device = device
+        self._resident = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks = {name: threading.Lock() for name in self.specs}
+        # Footprint measured on a previous load beats any pre-load estimate
+        self._measured_bytes = {}
+        self.stats = {'hits': 0, 'loads': 0, 'evictions': 0}
+
+    def names(self):
+        return list(self.specs)
+
+    def resident_bytes(self):
+        return sum(m.memory_bytes for m in self._resident.values())
+
+    def get_resident(self, name):
+        """Return the model for `name` if it is already loaded, else None"""
+        with self._lock:
+            model = self._resident.get(name)
+            if model is not None:
+                self._resident.move_to_end(name)
+                self.stats['hits'] += 1
+            return model
+
+    def get(self, name):
+        """Return the loaded model for `name`, loading it if needed"""
+        if name not in self.specs:
+            raise KeyError(f"Unknown model: {name}")
+
+        model = self.get_resident(name)
+        if model is not None:
+            return model
+
+        # One loader per model; requests for other models are not blocked
+        with self._load_locks[name]:
+            with self._lock:
+                model = self._resident.get(name)
+                if model is not None:
+                    self._resident.move_to_end(name)
+                    self.stats['hits'] += 1
+                    return model
+                spec = self.specs[name]
+                self._evict_for(self._measured_bytes.get(name) or spec.estimated_bytes())
+
+            logger.info(f"🏗️  Loading model '{name}' ({spec.kind}) from {spec.path}")
+            start = time.perf_counter()
+            model = MODEL_KINDS[spec.kind](spec, device=self.device)
+            logger.info(f"✅ Loaded '{name}' in {time.perf_counter() - start:.1f}s "
+                        f"({model.memory_bytes / 2**20:.0f} MB)")
+
+            with self._lock:
+                self._measured_bytes[name] = model.memory_bytes
+                self._evict_for(model.memory_bytes)
+                self._resident[name] = model
+                self.stats['loads'] += 1
+            return model
+
+    def _evict_for(self, incoming_bytes):
+        """Drop LRU models until `incoming_bytes` fits; caller holds self._lock"""
+        while self._resident and self.resident_bytes() + incoming_bytes > self.memory_budget:
+            name, model = self._resident.popitem(last=False)
+            self.stats['evictions'] += 1
+            logger.info(f"♻️  Evicted model '{name}' ({model.memory_bytes / 2**20:.0f} MB)")
+        if incoming_bytes > self.memory_budget:
+            logger.warning(f"⚠️  Model of {incoming_bytes / 2**20:.0f} MB exceeds the "
+                           f"{self.memory_budget / 2**20:.0f} MB budget; serving it alone")
+
+    def status(self):
+        with self._lock:
+            resident = {name: m.memory_bytes for name, m in self._resident.items()}
+        return {
+            'models': [spec.to_dict() for spec in self.specs.values()],
+            'resident': list(resident),
+            'resident_mb': round(sum(resident.values()) / 2**20, 1),
+            'budget_mb': round(self.memory_budget / 2**20, 1),
+            **self.stats,
+        }
+
+
+class BatchScheduler:
+    """
+    One request queue and one worker pool shared by every model.
+
+    A dispatcher thread drains the queue for up to `max_wait_ms` (or until
+    `max_batch_size` requests are pending), groups the requests by model
+    name and hands each group to the pool as a single batched forward pass.
+    Groups for a model that is not resident go to a separate loader thread
+    first, so a cold load never occupies an inference worker.
+    """
+
+    def __init__(self, registry, max_batch_size=16, max_wait_ms=10, num_workers=2):
+        self.registry = registry
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.pool = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='infer')
+        self.loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='model-load')
+        self._queue = queue.Queue()
+        self._stopped = threading.Event()
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name='batch-dispatch', daemon=True)
+        self._dispatcher.start()
+
+    def submit(self, model_name, img):
+        """Queue one PIL image for `model_name`; returns a Future of the prediction dict"""
+        if model_name not in self.registry.specs:
+            raise KeyError(f"Unknown model: {model_name}")
+        future = Future()
+        self._queue.put((model_name, img, future))
+        return future
+
+    def shutdown(self):
+        self._stopped.set()
+        self._dispatcher.join()
+        self.loader.shutdown(wait=True)
+        self.pool.shutdown(wait=True)
+
+    def _dispatch_loop(self):
+        while not self._stopped.is_set():
+            try:
+                first = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            pending = [first]
+            deadline = time.monotonic() + self.max_wait
+            while len(pending) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            groups = OrderedDict()
+            for model_name, img, future in pending:
+                groups.setdefault(model_name, []).append((img, future))
+            for model_name, items in groups.items():
+                model = self.registry.get_resident(model_name)
+                if model is not None:
+                    self.pool.submit(self._run_batch, model, items)
+                else:
+                    self.loader.submit(self._load_then_run, model_name, items)
+
+    def _load_then_run(self, model_name, items):
+        try:
+            model = self.registry.get(model_name)
+        except Exception as e:
+            for _, future in items:
+                future.set_exception(e)
+            return
+        self.pool.submit(self._run_batch, model, items)
+
+    def _run_batch(self, model, items):
+        inputs, futures = [], []
+        for img, future in items:
+            try:
+                inputs.append(model.preprocess(img))
+                futures.append(future)
+            except Exception as e:
+                future.set_exception(e)
+        if not inputs:
+            return
+
+        try:
+            probs = model.predict(np.stack(inputs))
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        for future, p in zip(futures, probs):
+            future.set_result(format_prediction(p, model.class_names))
@@ -0,0 +1,164 @@
+"""
+RETINA Model Server
+One Flask process serving every model through the shared model registry
+
+Models are routed by name, loaded on first use and evicted least-recently-used
+when the memory budget is exceeded. All models share one batching queue and
+one inference thread pool (see model_registry.py).
+
+Usage:
+    python model_server.py
+    python model_server.py --memory-budget-mb 3072 --config models.json
+
+API Endpoints:
+    GET  /health                       - Health check
+    GET  /models                       - Registered and resident models
+    POST /models/<name>/analyze        - Analyze one image
+    POST /models/<name>/batch-analyze  - Analyze multiple images
+"""
+
+import argparse
+import base64
+import io
+import logging
+
+from flask import Flask, request, jsonify
+from flask_cors import CORS
+from PIL import Image
+
+from model_registry import ModelRegistry, BatchScheduler, load_model_specs
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+app = Flask(__name__)
+CORS(app)
+
+registry = None
+scheduler = None
+
+REQUEST_TIMEOUT = 60
+
+
+def decode_image(image_data):
+    """Decode a base64 (optionally data-URI) image into a PIL image"""
+    if ',' in image_data:
+        image_data = image_data.split(',')[1]
+    return Image.open(io.BytesIO(base64.b64decode(image_data))).convert('RGB')
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    """Health check endpoint"""
+    return jsonify({
+        'status': 'healthy' if scheduler is not None else 'unhealthy',
+        'models': registry.names() if registry is not None else [],
+    })
+
+
+@app.route('/models', methods=['GET'])
+def models():
+    """Registered models, resident set and memory usage"""
+    return jsonify(registry.status())
+
+
+@app.route('/models/<name>/analyze', methods=['POST'])
+def analyze(name):
+    """Analyze eye image endpoint"""
+    try:
+        if name not in registry.specs:
+            return jsonify({'error': f'Unknown model: {name}'}), 404
+
+        data = request.json
+        if 'image' not in data:
+            return jsonify({'error': 'No image provided'}), 400
+
+        image = decode_image(data['image'])
+        result = scheduler.submit(name, image).result(timeout=REQUEST_TIMEOUT)
+        result['model'] = name
+
+        logger.info(f"✅ [{name}] {result['predicted_class']} ({result['confidence']:.2%})")
+        return jsonify(result)
+
+    except Exception as e:
+        logger.error(f"❌ [{name}] Analysis error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/models/<name>/batch-analyze', methods=['POST'])
+def batch_analyze(name):
+    """Batch analyze multiple images"""
+    try:
+        if name not in registry.specs:
+            return jsonify({'error': f'Unknown model: {name}'}), 404
+
+        data = request.json
+        if 'images' not in data or not isinstance(data['images'], list):
+            return jsonify({'error': 'No images array provided'}), 400
+
+        # Submit everything first so the scheduler can batch the whole request
+        futures = []
+        for image_data in data['images']:
+            try:
+                futures.append(scheduler.submit(name, decode_image(image_data)))
+            except Exception as e:
+                futures.append(e)
+
+        results = []
+        for idx, future in enumerate(futures):
+            try:
+                if isinstance(future, Exception):
+                    raise future
+                results.append({'index': idx, **future.result(timeout=REQUEST_TIMEOUT)})
+            except Exception as e:
+                logger.error(f"Error processing image {idx}: {e}")
+                results.append({'index': idx, 'error': str(e)})
+
+        logger.info(f"✅ [{name}] Batch analysis complete: {len(results)} images")
+        return jsonify({'results': results, 'model': name})
+
+    except Exception as e:
+        logger.error(f"❌ [{name}] Batch analysis error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+def main():
+    global registry, scheduler
+
+    parser = argparse.ArgumentParser(description='RETINA multi-model server')
+    parser.add_argument('--config', help='JSON file with extra model specs (versions, A/B variants)')
+    parser.add_argument('--memory-budget-mb', type=float, default=4096,
+                        help='RAM budget for resident models')
+    parser.add_argument('--max-batch-size', type=int, default=16, help='Max images per forward pass')
+    parser.add_argument('--max-wait-ms', type=float, default=10,
+                        help='How long to wait for a batch to fill')
+    parser.add_argument('--workers', type=int, default=2, help='Inference thread pool size')
+    parser.add_argument('--preload', nargs='*', default=[], help='Models to load at startup')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("🏥 RETINA: Model Server")
+    print("=" * 60)
+
+    registry = ModelRegistry(load_model_specs(args.config), memory_budget_mb=args.memory_budget_mb)
+    scheduler = BatchScheduler(registry, max_batch_size=args.max_batch_size,
+                               max_wait_ms=args.max_wait_ms, num_workers=args.workers)
+
+    for name in args.preload:
+        registry.get(name)
+
+    print(f"\n📦 Models: {', '.join(registry.names())}")
+    print(f"💾 Memory budget: {args.memory_budget_mb:.0f} MB")
+    print("\nEndpoints:")
+    print(f"  GET  http://localhost:{args.port}/health")
+    print(f"  GET  http://localhost:{args.port}/models")
+    print(f"  POST http://localhost:{args.port}/models/<name>/analyze")
+    print(f"  POST http://localhost:{args.port}/models/<name>/batch-analyze")
+    print("\n" + "=" * 60)
+
+    app.run(host='0.0.0.0', port=args.port, debug=False, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,7 +11,11 @@ This script helps you:
 Usage:
     python retfound_setup.py --mode setup        # Initial setup
     python retfound_setup.py --mode train        # Train model
+    python retfound_setup.py --mode train --nproc 4   # Data-parallel CPU training
+    python retfound_setup.py --mode train --profile   # Step timing breakdown
     python retfound_setup.py --mode test         # Test model
+    python retfound_setup.py --mode test --from-cache --thresholds 0.5 0.3 0.5 0.5   # Re-score cached logits
+    python retfound_setup.py --mode test --from-cache --head-checkpoint new.pth      # Re-score cached embeddings
 """
 
 import os
@@ -19,12 +23,18 @@ import sys
 import argparse
 import torch
 import torch.nn as nn
-from torch.utils.data import DataLoader, random_split
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data import DataLoader, Subset, random_split
+from torch.utils.data.distributed import DistributedSampler
 from torchvision import datasets, transforms
 import timm
 from tqdm import tqdm
 import json
 from pathlib import Path
+from training_profiler import StepProfiler
+from evaluation import StreamingEvaluator, evaluate_cache, linear_head, print_report
 
 DATASET_PATH = Path('../datasets')
 MODEL_SAVE_PATH = Path('../models/retfound')
@@ -110,44 +120,119 @@ def fine_tune_retfound(
     epochs=20,
     batch_size=32,
     learning_rate=1e-4,
-    device='cuda' if torch.cuda.is_available() else 'cpu'
+    device='cuda' if torch.cuda.is_available() else 'cpu',
+    nproc=1,
+    profile=False,
+    profile_trace_steps=0
 ):
-    """Fine-tune RETFound on your dataset"""
+    """Fine-tune RETFound on your dataset
+    
+    With nproc > 1, trains with DistributedDataParallel over the gloo backend
+    in `nproc` local CPU processes; `batch_size` is then per process. Only
+    rank 0 writes checkpoints, and the history is returned as read back from
+    training_history.json (the model itself stays in the worker processes).
+    
+    With profile=True, rank 0 times every training step and writes
+    training_profile.json; profile_trace_steps > 0 also captures a
+    torch.profiler trace of that many steps.
+    """
+    if nproc > 1:
+        os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+        os.environ.setdefault('MASTER_PORT', '29500')
+        mp.spawn(
+            _fine_tune_worker,
+            args=(nproc, epochs, batch_size, learning_rate, 'cpu', profile, profile_trace_steps),
+            nprocs=nproc,
+            join=True
+        )
+        with open(MODEL_SAVE_PATH / 'training_history.json') as f:
+            return None, json.load(f)
     
-    print("🚀 Starting RETFound Fine-tuning")
-    print(f"Device: {device}")
-    print(f"Epochs: {epochs}")
-    print(f"Batch Size: {batch_size}")
-    print(f"Learning Rate: {learning_rate}")
-    print("-" * 50)
+    return _fine_tune_worker(0, 1, epochs, batch_size, learning_rate, device, profile, profile_trace_steps)
+
+def _all_reduce_sum(values):
+    """Sum a list of per-rank scalars across all processes"""
+    tensor = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.tolist()
+
+def _fine_tune_worker(rank, world_size, epochs, batch_size, learning_rate, device='cpu',
+                      profile=False, profile_trace_steps=0):
+    """Training loop for one process (rank 0 of 1 when not distributed)"""
+    distributed = world_size > 1
+    is_main = rank == 0
+    
+    num_workers = 4
+    if distributed:
+        dist.init_process_group('gloo', rank=rank, world_size=world_size)
+        # Split the single-process budget of cores and decode workers between
+        # ranks instead of every rank using all of them
+        num_workers = max(1, 4 // world_size)
+        cores_per_rank = (os.cpu_count() or 1) // world_size
+        torch.set_num_threads(max(1, cores_per_rank - num_workers))
+        device = 'cpu'
+    
+    log = print if is_main else (lambda *a, **k: None)
+    
+    log("🚀 Starting RETFound Fine-tuning")
+    log(f"Device: {device}")
+    if distributed:
+        log(f"Processes: {world_size} (gloo, {torch.get_num_threads()} threads, "
+            f"{num_workers} loader workers each)")
+    log(f"Epochs: {epochs}")
+    log(f"Batch Size: {batch_size}{' per process' if distributed else ''}")
+    log(f"Learning Rate: {learning_rate}")
+    log("-" * 50)
     
     train_transform, val_transform = get_data_transforms()
     
-    print("📚 Loading dataset...")
+    log("📚 Loading dataset...")
     full_dataset = datasets.ImageFolder(str(DATASET_PATH), transform=train_transform)
     
-    print(f"✅ Total images: {len(full_dataset)}")
-    print(f"Classes: {full_dataset.classes}")
+    log(f"✅ Total images: {len(full_dataset)}")
+    log(f"Classes: {full_dataset.classes}")
     
     train_size = int(0.8 * len(full_dataset))
     val_size = len(full_dataset) - train_size
-    train_dataset, val_dataset = random_split(full_dataset, [train_size, val_size])
+    # Fixed seed so every rank gets the same split
+    split_generator = torch.Generator().manual_seed(42) if distributed else None
+    train_dataset, val_dataset = random_split(full_dataset, [train_size, val_size], generator=split_generator)
     
     val_dataset.dataset.transform = val_transform
     
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=4)
-    val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, num_workers=4)
+    if distributed:
+        train_sampler = DistributedSampler(train_dataset, num_replicas=world_size, rank=rank, shuffle=True)
+        train_loader = DataLoader(train_dataset, batch_size=batch_size, sampler=train_sampler, num_workers=num_workers)
+        # Strided shards without DistributedSampler's padding, so every validation
+        # image is counted exactly once and val_acc matches a single-process run
+        val_shard = Subset(val_dataset, range(rank, len(val_dataset), world_size))
+        val_loader = DataLoader(val_shard, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    else:
+        train_sampler = None
+        train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
+        val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
     
-    print(f"📊 Training samples: {len(train_dataset)}")
-    print(f"📊 Validation samples: {len(val_dataset)}")
+    log(f"📊 Training samples: {len(train_dataset)}")
+    log(f"📊 Validation samples: {len(val_dataset)}")
     
     model = load_retfound_model(num_classes=len(CLASS_NAMES))
     model = model.to(device)
+    if distributed:
+        model = DDP(model)
+    # Checkpoints keep the plain (non-DDP) state_dict keys
+    base_model = model.module if distributed else model
     
     criterion = nn.CrossEntropyLoss()
     optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate)
     scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=epochs)
     
+    profiler = StepProfiler(
+        enabled=profile and is_main,
+        sync=torch.cuda.synchronize if str(device).startswith('cuda') else None,
+        trace_steps=profile_trace_steps,
+        trace_dir=MODEL_SAVE_PATH / 'profile_trace'
+    )
+    
     best_val_acc = 0.0
     history = {
         'train_loss': [],
@@ -157,35 +242,50 @@ def fine_tune_retfound(
     }
     
     for epoch in range(epochs):
-        print(f"\n📈 Epoch {epoch+1}/{epochs}")
+        log(f"\n📈 Epoch {epoch+1}/{epochs}")
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
         
         model.train()
         train_loss = 0.0
         train_correct = 0
         train_total = 0
         
-        pbar = tqdm(train_loader, desc="Training")
+        pbar = tqdm(train_loader, desc="Training", disable=not is_main)
+        profiler.start()
         for images, labels in pbar:
+            profiler.lap('data')
             images, labels = images.to(device), labels.to(device)
+            profiler.lap('to_device')
             
             optimizer.zero_grad()
             outputs = model(images)
             loss = criterion(outputs, labels)
+            profiler.lap('forward')
             loss.backward()
+            profiler.lap('backward')
             optimizer.step()
+            profiler.lap('optimizer')
             
             train_loss += loss.item()
             _, predicted = outputs.max(1)
             train_total += labels.size(0)
             train_correct += predicted.eq(labels).sum().item()
+            profiler.lap('metrics_sync')
             
             pbar.set_postfix({
                 'loss': f"{train_loss/len(pbar):.4f}",
                 'acc': f"{100.*train_correct/train_total:.2f}%"
             })
+            profiler.lap('progress_bar')
+            profiler.end_step(labels.size(0))
         
+        train_batches = len(train_loader)
+        if distributed:
+            train_loss, train_batches, train_correct, train_total = _all_reduce_sum(
+                [train_loss, train_batches, train_correct, train_total])
         train_acc = 100. * train_correct / train_total
-        avg_train_loss = train_loss / len(train_loader)
+        avg_train_loss = train_loss / train_batches
         
         model.eval()
         val_loss = 0.0
@@ -193,7 +293,7 @@ def fine_tune_retfound(
         val_total = 0
         
         with torch.no_grad():
-            pbar = tqdm(val_loader, desc="Validation")
+            pbar = tqdm(val_loader, desc="Validation", disable=not is_main)
             for images, labels in pbar:
                 images, labels = images.to(device), labels.to(device)
                 outputs = model(images)
@@ -204,51 +304,94 @@ def fine_tune_retfound(
                 val_total += labels.size(0)
                 val_correct += predicted.eq(labels).sum().item()
         
+        val_batches = len(val_loader)
+        if distributed:
+            val_loss, val_batches, val_correct, val_total = _all_reduce_sum(
+                [val_loss, val_batches, val_correct, val_total])
         val_acc = 100. * val_correct / val_total
-        avg_val_loss = val_loss / len(val_loader)
+        avg_val_loss = val_loss / val_batches
         
         history['train_loss'].append(avg_train_loss)
         history['train_acc'].append(train_acc)
         history['val_loss'].append(avg_val_loss)
         history['val_acc'].append(val_acc)
         
-        print(f"Train Loss: {avg_train_loss:.4f}, Train Acc: {train_acc:.2f}%")
-        print(f"Val Loss: {avg_val_loss:.4f}, Val Acc: {val_acc:.2f}%")
+        log(f"Train Loss: {avg_train_loss:.4f}, Train Acc: {train_acc:.2f}%")
+        log(f"Val Loss: {avg_val_loss:.4f}, Val Acc: {val_acc:.2f}%")
         
         if val_acc > best_val_acc:
             best_val_acc = val_acc
-            save_path = MODEL_SAVE_PATH / 'retfound_finetuned_best.pth'
-            torch.save({
-                'epoch': epoch,
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-                'val_acc': val_acc,
-                'class_names': CLASS_NAMES,
-            }, save_path)
-            print(f"💾 Saved best model: {save_path} (Val Acc: {val_acc:.2f}%)")
+            if is_main:
+                save_path = MODEL_SAVE_PATH / 'retfound_finetuned_best.pth'
+                torch.save({
+                    'epoch': epoch,
+                    'model_state_dict': base_model.state_dict(),
+                    'optimizer_state_dict': optimizer.state_dict(),
+                    'val_acc': val_acc,
+                    'class_names': full_dataset.classes,
+                }, save_path)
+                print(f"💾 Saved best model: {save_path} (Val Acc: {val_acc:.2f}%)")
         
         scheduler.step()
     
-    final_save_path = MODEL_SAVE_PATH / 'retfound_finetuned.pth'
-    torch.save({
-        'model_state_dict': model.state_dict(),
-        'optimizer_state_dict': optimizer.state_dict(),
-        'class_names': CLASS_NAMES,
-        'history': history,
-    }, final_save_path)
-    print(f"\n✅ Training complete!")
-    print(f"💾 Final model saved: {final_save_path}")
-    print(f"🏆 Best validation accuracy: {best_val_acc:.2f}%")
-    
-    with open(MODEL_SAVE_PATH / 'training_history.json', 'w') as f:
-        json.dump(history, f, indent=2)
-    
-    return model, history
+    if is_main:
+        final_save_path = MODEL_SAVE_PATH / 'retfound_finetuned.pth'
+        torch.save({
+            'model_state_dict': base_model.state_dict(),
+            'optimizer_state_dict': optimizer.state_dict(),
+            'class_names': full_dataset.classes,
+            'history': history,
+        }, final_save_path)
+        print(f"\n✅ Training complete!")
+        print(f"💾 Final model saved: {final_save_path}")
+        print(f"🏆 Best validation accuracy: {best_val_acc:.2f}%")
+        
+        with open(MODEL_SAVE_PATH / 'training_history.json', 'w') as f:
+            json.dump(history, f, indent=2)
+        
+        profiler.save(MODEL_SAVE_PATH / 'training_profile.json', extra={
+            'batch_size': batch_size,
+            'num_workers': train_loader.num_workers,
+            'world_size': world_size,
+            'device': str(device),
+        })
+    
+    if distributed:
+        dist.barrier()
+        dist.destroy_process_group()
+    
+    return base_model, history
 
-def test_model():
-    """Test the fine-tuned model"""
+def test_model(from_cache=False, thresholds=None, head_checkpoint=None):
+    """Test the fine-tuned model
+    
+    Logits and embeddings are cached to test_logits.npz, so from_cache=True
+    recomputes the metrics (e.g. with new per-class thresholds) instantly.
+    With head_checkpoint, the cached embeddings are re-scored with that
+    checkpoint's classification head instead, skipping the ViT backbone.
+    """
     print("🧪 Testing RETFound model...")
     
+    cache_path = MODEL_SAVE_PATH / 'test_logits.npz'
+    metrics_path = MODEL_SAVE_PATH / 'test_metrics.json'
+    
+    if from_cache:
+        if not cache_path.exists():
+            print(f"❌ No cached logits found at {cache_path}. Run --mode test first.")
+            return
+        head = None
+        if head_checkpoint:
+            state_dict = torch.load(head_checkpoint, map_location='cpu')['model_state_dict']
+            head = linear_head(state_dict['head.weight'].numpy(), state_dict['head.bias'].numpy())
+            print(f"⚡ Re-scoring cached embeddings with head from: {head_checkpoint}")
+        else:
+            print(f"⚡ Evaluating cached logits: {cache_path}")
+        metrics = evaluate_cache(cache_path, thresholds=thresholds, head=head)
+        print_report(metrics)
+        with open(metrics_path, 'w') as f:
+            json.dump(metrics, f, indent=2)
+        return metrics
+    
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     
     model = load_retfound_model(num_classes=len(CLASS_NAMES))
@@ -272,33 +415,30 @@ def test_model():
     test_dataset = datasets.ImageFolder(str(DATASET_PATH), transform=val_transform)
     test_loader = DataLoader(test_dataset, batch_size=32, shuffle=False)
     
-    correct = 0
-    total = 0
-    class_correct = {i: 0 for i in range(len(CLASS_NAMES))}
-    class_total = {i: 0 for i in range(len(CLASS_NAMES))}
+    # Labels (and the trained head's outputs) follow ImageFolder's sorted
+    # folder order, not CLASS_NAMES, so report metrics under those names
+    if len(test_dataset.classes) != len(CLASS_NAMES):
+        print(f"❌ Dataset has {len(test_dataset.classes)} classes {test_dataset.classes}, "
+              f"model has {len(CLASS_NAMES)} outputs")
+        return
+    evaluator = StreamingEvaluator(test_dataset.classes, thresholds=thresholds, keep_scores=True)
     
     with torch.no_grad():
         for images, labels in tqdm(test_loader, desc="Testing"):
             images, labels = images.to(device), labels.to(device)
-            outputs = model(images)
-            _, predicted = outputs.max(1)
-            
-            total += labels.size(0)
-            correct += predicted.eq(labels).sum().item()
-            
-            for i in range(labels.size(0)):
-                label = labels[i].item()
-                class_total[label] += 1
-                if predicted[i] == labels[i]:
-                    class_correct[label] += 1
-    
-    overall_acc = 100. * correct / total
-    print(f"\n🎯 Overall Accuracy: {overall_acc:.2f}%")
-    print("\nPer-class Accuracy:")
-    for i, class_name in enumerate(CLASS_NAMES):
-        if class_total[i] > 0:
-            class_acc = 100. * class_correct[i] / class_total[i]
-            print(f"  {class_name}: {class_acc:.2f}% ({class_correct[i]}/{class_total[i]})")
+            embeddings = model.forward_head(model.forward_features(images), pre_logits=True)
+            outputs = model.head(embeddings)
+            evaluator.update(outputs, labels, embeddings=embeddings)
+    
+    metrics = evaluator.compute()
+    print_report(metrics)
+    
+    evaluator.save_cache(cache_path)
+    with open(metrics_path, 'w') as f:
+        json.dump(metrics, f, indent=2)
+    print(f"\n💾 Saved logits cache: {cache_path}")
+    print(f"💾 Saved metrics: {metrics_path}")
+    return metrics
 
 def main():
     parser = argparse.ArgumentParser(description='RETFound Setup and Training')
@@ -307,8 +447,24 @@ def main():
     parser.add_argument('--epochs', type=int, default=20, help='Number of training epochs')
     parser.add_argument('--batch-size', type=int, default=32, help='Batch size')
     parser.add_argument('--lr', type=float, default=1e-4, help='Learning rate')
+    parser.add_argument('--nproc', type=int, default=1,
+                        help='Local CPU processes for DistributedDataParallel training (batch size is per process)')
+    parser.add_argument('--profile', action='store_true',
+                        help='Record per-step data/compute timings to training_profile.json')
+    parser.add_argument('--profile-trace-steps', type=int, default=0,
+                        help='With --profile, also capture a torch.profiler trace of this many steps')
+    parser.add_argument('--from-cache', action='store_true',
+                        help='Test mode: re-evaluate cached logits instead of running the model')
+    parser.add_argument('--thresholds', type=float, nargs='+',
+                        help='Test mode: per-class probability thresholds, in sorted class-folder order')
+    parser.add_argument('--head-checkpoint',
+                        help='Test mode with --from-cache: re-score cached embeddings with this checkpoint\'s head')
     
     args = parser.parse_args()
+    if args.head_checkpoint and not args.from_cache:
+        parser.error("--head-checkpoint requires --from-cache")
+    if args.thresholds is not None and len(args.thresholds) != len(CLASS_NAMES):
+        parser.error(f"--thresholds needs {len(CLASS_NAMES)} values (one per class), got {len(args.thresholds)}")
     
     print("=" * 60)
     print("🏥 RETINA: RETFound Integration")
@@ -338,12 +494,16 @@ def main():
         fine_tune_retfound(
             epochs=args.epochs,
             batch_size=args.batch_size,
-            learning_rate=args.lr
+            learning_rate=args.lr,
+            nproc=args.nproc,
+            profile=args.profile,
+            profile_trace_steps=args.profile_trace_steps
         )
     
     elif args.mode == 'test':
         print("\n🧪 Test Mode")
-        test_model()
+        test_model(from_cache=args.from_cache, thresholds=args.thresholds,
+                   head_checkpoint=args.head_checkpoint)
 
 if __name__ == '__main__':
     main()
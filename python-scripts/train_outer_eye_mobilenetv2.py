@@ -1,4 +1,6 @@
 import os
+import json
+import argparse
 import numpy as np
 import tensorflow as tf
 from tensorflow.keras.preprocessing import image
@@ -6,8 +8,9 @@ from tensorflow.keras.utils import to_categorical
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import LabelEncoder
 from imblearn.over_sampling import SMOTE
-from sklearn.metrics import classification_report
 from tqdm import tqdm
+from training_profiler import StepProfiler, keras_profiled_fit
+from evaluation import StreamingEvaluator, print_report
 
 # -----------------------------
 # 🧠 CONFIGURATION
@@ -24,6 +27,13 @@ MODEL_TFLITE = "outer_eye_mobilenetv2.tflite"
 # Disease categories — make sure these match your folder names exactly
 DISEASES = ["Normal", "Uveitis", "Conjunctivitis", "Cataract", "Eyelid Drooping"]
 
+parser = argparse.ArgumentParser(description="Train the outer-eye MobileNetV2 classifier")
+parser.add_argument("--profile", action="store_true",
+                    help="Record per-step data/compute timings to outer_eye_training_profile.json")
+parser.add_argument("--profile-trace-steps", type=int, default=0,
+                    help="With --profile, also capture a TensorFlow profiler trace of this many steps")
+args = parser.parse_args()
+
 # -----------------------------
 # 📂 LOAD DATASET
 # -----------------------------
@@ -118,24 +128,43 @@ model.summary()
 EPOCHS = 15
 BATCH_SIZE = 32
 
-print("\n🚀 Starting training...")
-history = model.fit(
-    X_train, y_train,
-    validation_data=(X_val, y_val),
-    epochs=EPOCHS,
-    batch_size=BATCH_SIZE,
-    verbose=1
+profiler = StepProfiler(
+    enabled=args.profile,
+    trace_steps=args.profile_trace_steps,
+    trace_backend="tf",
+    trace_dir=os.path.join(MODEL_DIR, "profile_trace"),
 )
 
+print("\n🚀 Starting training...")
+if args.profile:
+    # Manual tf.data loop so data wait can be timed apart from the train step
+    keras_profiled_fit(model, X_train, y_train, (X_val, y_val), EPOCHS, BATCH_SIZE, profiler)
+else:
+    history = model.fit(
+        X_train, y_train,
+        validation_data=(X_val, y_val),
+        epochs=EPOCHS,
+        batch_size=BATCH_SIZE,
+        verbose=1
+    )
+
+if args.profile:
+    os.makedirs(MODEL_DIR, exist_ok=True)
+    profiler.save(os.path.join(MODEL_DIR, "outer_eye_training_profile.json"),
+                  extra={"batch_size": BATCH_SIZE})
+
 # -----------------------------
 # 📊 VALIDATION RESULTS
 # -----------------------------
 print("\n📈 Evaluating model...")
-y_pred = np.argmax(model.predict(X_val), axis=1)
+# LabelEncoder sorts class names, so report them in encoded order
+evaluator = StreamingEvaluator(le.classes_, keep_scores=True)
 y_true = np.argmax(y_val, axis=1)
+for start in range(0, len(X_val), BATCH_SIZE):
+    probs = model(X_val[start:start + BATCH_SIZE], training=False)
+    evaluator.update(probs, y_true[start:start + BATCH_SIZE], from_probs=True)
 
-print("\n📋 Classification Report:")
-print(classification_report(y_true, y_pred, target_names=DISEASES))
+print_report(evaluator.compute())
 
 # -----------------------------
 # 💾 SAVE MODEL
@@ -145,6 +174,16 @@ model_path = os.path.join(MODEL_DIR, MODEL_NAME)
 model.save(model_path)
 print(f"✅ Saved Keras model: {model_path}")
 
+# Output index -> class name, read back by model_registry.py
+classes_path = os.path.join(MODEL_DIR, os.path.splitext(MODEL_NAME)[0] + ".classes.json")
+with open(classes_path, "w") as f:
+    json.dump([str(c) for c in le.classes_], f)
+print(f"✅ Saved class order: {classes_path}")
+
+cache_path = os.path.join(MODEL_DIR, "outer_eye_val_scores.npz")
+evaluator.save_cache(cache_path)
+print(f"✅ Saved validation scores: {cache_path}")
+
 # Convert to TensorFlow Lite
 converter = tf.lite.TFLiteConverter.from_keras_model(model)
 tflite_model = converter.convert()